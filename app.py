@@ -1,42 +1,124 @@
 import os
 import requests
+import pybreaker
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import logging
-import json
+import orjson
 import time
+import threading
+import atexit
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone, timedelta
+from urllib.parse import quote
 from dotenv import load_dotenv
+from cachetools import TTLCache, TLRUCache
 
 # Slack
 from slack_bolt import App
-from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_bolt.adapter.asgi import SlackRequestHandler
+from slack_bolt.request import BoltRequest
 from slack_sdk.errors import SlackApiError
 
-# Google
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
-# ログ設定
-logging.basicConfig(level=logging.INFO)
+# ログ設定（Cloud Loggingが解釈できるよう、1行1件のJSONで出力する）
+class JsonFormatter(logging.Formatter):
+    """ログレコードをCloud Logging向けのJSON文字列に変換する"""
+    def format(self, record):
+        entry = {"severity": record.levelname, "message": record.getMessage(), "logger": record.name}
+        if record.exc_info:
+            entry["stack_trace"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonFormatter())
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
+logger = logging.getLogger(__name__)
 
 
 # --- .envファイルから認証情報を取得 ---
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
 SLACK_APP_TOKEN = os.environ.get("SLACK_APP_TOKEN")
+SLACK_SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET")
 FREEEE_API_TOKEN = os.environ.get("FREEEE_API_TOKEN")
 FREEEE_COMPANY_ID = os.environ.get("FREEEE_COMPANY_ID")
+# freee APIのリクエストボディでは数値で渡すため、起動時に一度だけ変換しておく
+FREEEE_COMPANY_ID_INT = int(FREEEE_COMPANY_ID) if FREEEE_COMPANY_ID else None
 GOOGLE_CALENDAR_ID = os.environ.get("GOOGLE_CALENDAR_ID")
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
 GOOGLE_REFRESH_TOKEN = os.environ.get("GOOGLE_REFRESH_TOKEN")
 
+# freee人事労務APIのエンドポイント（会社IDは起動時に埋め込み、従業員IDや日付は呼び出しごとにformatで差し込む）
+FREEE_HR_API_BASE_URL = "https://api.freee.co.jp/hr/api/v1"
+FREEE_EMPLOYEES_URL = f"{FREEE_HR_API_BASE_URL}/companies/{FREEEE_COMPANY_ID}/employees"
+FREEE_TIME_CLOCKS_URL = FREEE_HR_API_BASE_URL + "/employees/{employee_id}/time_clocks"
+FREEE_WORK_RECORD_URL = FREEE_HR_API_BASE_URL + "/employees/{employee_id}/work_records/{date}"
+FREEE_WORK_RECORD_TEMPLATES_URL = FREEE_HR_API_BASE_URL + "/employees/{employee_id}/work_records/templates"
+
+# 外部APIのタイムアウト（接続, 読み込み）。応答がないままワーカーが塞がり続けるのを防ぐ
+HTTP_TIMEOUT = (3.05, 10)
+
+# Socket Modeで同時に処理するSlackリクエスト数（ハンドラーはI/O待ちが大半のため多めに確保する）
+SLACK_SOCKET_MODE_CONCURRENCY = int(os.environ.get("SLACK_SOCKET_MODE_CONCURRENCY", "20"))
+
+# 休暇申請で1日ごとの勤務記録を並列送信する際の同時実行数（freeeのレート制限に配慮して絞る）
+LEAVE_REQUEST_MAX_CONCURRENCY = 5
+
+# 打刻直後は勤務記録の反映待ちで勤怠タグ更新が404になるため、間隔を倍々にして再試行する回数
+TAG_UPDATE_MAX_ATTEMPTS = 4
+
+# Slackユーザー→freee従業員IDのキャッシュを永続化するSQLiteファイル（ワーカー間・再起動後も共有する）
+EMPLOYEE_CACHE_DB_PATH = os.environ.get("EMPLOYEE_CACHE_DB_PATH", "cache.db")
+EMPLOYEE_CACHE_TTL_SECONDS = 24 * 60 * 60
+
 # Slack Boltアプリを初期化
-app = App(token=SLACK_BOT_TOKEN)
+app = App(token=SLACK_BOT_TOKEN, signing_secret=SLACK_SIGNING_SECRET)
+
+# freee API用のHTTPセッション（Keep-Aliveで接続を使い回し、レート制限や一時的な障害は自動で再試行する）
+# リクエストボディはorjsonでシリアライズしてdata=で渡すため、Content-Typeはセッション側で指定しておく
+# 再試行を使い切った場合もレスポンスを返させ、raise_for_status()で従来通りエラー処理する
+# 打刻のPOSTは冪等ではなく、504や読み込みタイムアウトでもfreee側で登録済みの場合があるため再送しない
+FREEE_RETRY = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                    allowed_methods=frozenset({"GET", "PUT"}), respect_retry_after_header=True, raise_on_status=False)
+FREEE_SESSION = requests.Session()
+# 同時接続数はバックグラウンド処理(8) × 休暇申請の並列送信(5) が同時に走っても接続を使い回せる数にしておく
+FREEE_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=50, max_retries=FREEE_RETRY))
+FREEE_SESSION.headers.update({"Authorization": f"Bearer {FREEEE_API_TOKEN}", "Content-Type": "application/json"})
+
+# freee APIで障害（通信エラー・5xx）が続いた場合は、しばらく呼び出しを止めて即座に失敗させる
+FREEE_BREAKER = pybreaker.CircuitBreaker(fail_max=5, reset_timeout=30, name="freee")
+
+# Google API用のHTTPセッション（認証ヘッダーはトークン更新に追従するため呼び出しごとに付ける）
+GOOGLE_SESSION = requests.Session()
+GOOGLE_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+# ack()後に続けて行う処理（freeeへの問い合わせ、勤怠タグ設定、Slackへの通知など）を流すバックグラウンドスレッド
+BACKGROUND_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="slackbg")
+atexit.register(BACKGROUND_EXECUTOR.shutdown)
+
+# Slackユーザー→メールアドレス、メールアドレス→freee従業員IDのキャッシュ（どちらも滅多に変わらない）
+_email_cache = TTLCache(maxsize=1024, ttl=60 * 60)
+_employee_id_cache = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+# Slackユーザー→freee従業員IDの直接キャッシュ（ヒットすればSlackのusers_infoも呼ばない）
+# 値は(employee_id, updated_at)で、SQLiteの永続キャッシュと同じ時刻に期限切れになるようupdated_atから有効期限を決める
+_user_to_employee_id_cache = TLRUCache(maxsize=2048, ttu=lambda _user_id, entry, _now: entry[1] + EMPLOYEE_CACHE_TTL_SECONDS, timer=time.time)
+# 従業員ごとの休暇種別一覧のキャッシュ（1日の中ではほぼ変わらない）
+_leave_types_cache = TTLCache(maxsize=1024, ttl=6 * 60 * 60)
+_cache_lock = threading.Lock()
+
+# 永続キャッシュのSQLite接続（初回利用時に開く）
+_cache_db = None
+_cache_db_lock = threading.Lock()
+
+# Google Calendar APIの認証情報（初回利用時に生成してキャッシュする）
+_google_creds = None
+_google_lock = threading.Lock()
 
 
 # ----------------------------------------------------
@@ -44,142 +126,353 @@ app = App(token=SLACK_BOT_TOKEN)
 # ----------------------------------------------------
 
 def get_google_credentials():
-    """リフレッシュトークンを使ってGoogle APIの認証情報を生成・更新する"""
-    creds = Credentials.from_authorized_user_info(
-        info={
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "refresh_token": GOOGLE_REFRESH_TOKEN,
-        },
-        scopes=['https://www.googleapis.com/auth/calendar']
-    )
-    if not creds.valid and creds.expired and creds.refresh_token:
-        logging.info("Googleの認証情報が期限切れのため、リフレッシュします...")
-        creds.refresh(Request())
-    return creds
+    """リフレッシュトークンを使ってGoogle APIの認証情報を生成・更新する（生成済みであれば使い回す）"""
+    # google-authの読み込みは重く、カレンダー登録（現在はどこからも呼ばれていない）でしか使わないため必要になってから読み込む
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+
+    global _google_creds
+    with _google_lock:
+        if _google_creds is None:
+            _google_creds = Credentials.from_authorized_user_info(
+                info={
+                    "client_id": GOOGLE_CLIENT_ID,
+                    "client_secret": GOOGLE_CLIENT_SECRET,
+                    "refresh_token": GOOGLE_REFRESH_TOKEN,
+                },
+                scopes=['https://www.googleapis.com/auth/calendar']
+            )
+        if not _google_creds.valid and _google_creds.refresh_token:
+            logger.info("Googleの認証情報が期限切れのため、リフレッシュします...")
+            _google_creds.refresh(Request(session=GOOGLE_SESSION))
+        return _google_creds
+
+def invalidate_google_credentials():
+    """キャッシュ済みのGoogle認証情報を破棄し、次回利用時に取り直させる"""
+    global _google_creds
+    with _google_lock:
+        _google_creds = None
+
+# ----------------------------------------------------
+# 永続キャッシュ
+# ----------------------------------------------------
+
+def get_cache_db():
+    """従業員IDキャッシュ用のSQLite接続を取得する（呼び出し側で_cache_db_lockを保持すること）"""
+    global _cache_db
+    if _cache_db is None:
+        _cache_db = sqlite3.connect(EMPLOYEE_CACHE_DB_PATH, isolation_level=None, check_same_thread=False)
+        _cache_db.execute("PRAGMA journal_mode=WAL")
+        _cache_db.execute("CREATE TABLE IF NOT EXISTS emp(user_id TEXT PRIMARY KEY, employee_id INTEGER, updated_at INTEGER)")
+    return _cache_db
+
+def load_persisted_employee_id(user_id):
+    """永続キャッシュから有効期限内の(従業員ID, 保存時刻)を取得（なければNone）"""
+    try:
+        with _cache_db_lock:
+            row = get_cache_db().execute(
+                "SELECT employee_id, updated_at FROM emp WHERE user_id = ? AND updated_at > ?",
+                (user_id, int(time.time()) - EMPLOYEE_CACHE_TTL_SECONDS)
+            ).fetchone()
+        return tuple(row) if row else None
+    except sqlite3.Error as e:
+        logger.warning("従業員IDキャッシュ読み込みエラー: %s", e)
+        return None
+
+def delete_persisted_employee_id(user_id):
+    """永続キャッシュから従業員IDを削除する"""
+    try:
+        with _cache_db_lock:
+            get_cache_db().execute("DELETE FROM emp WHERE user_id = ?", (user_id,))
+    except sqlite3.Error as e:
+        logger.warning("従業員IDキャッシュ削除エラー: %s", e)
+
+def save_persisted_employee_id(user_id, employee_id, updated_at):
+    """従業員IDを永続キャッシュに保存する"""
+    try:
+        with _cache_db_lock:
+            get_cache_db().execute(
+                "INSERT OR REPLACE INTO emp(user_id, employee_id, updated_at) VALUES (?, ?, ?)",
+                (user_id, employee_id, updated_at)
+            )
+    except sqlite3.Error as e:
+        logger.warning("従業員IDキャッシュ書き込みエラー: %s", e)
 
 # ----------------------------------------------------
 # API連携ヘルパー関数
 # ----------------------------------------------------
 
 def get_email_from_slack(user_id, client):
-    """SlackのユーザーIDからメールアドレスを取得"""
+    """SlackのユーザーIDからメールアドレスを取得（キャッシュ済みであればAPIを呼ばない）"""
+    with _cache_lock:
+        email = _email_cache.get(user_id)
+    if email:
+        return email
     try:
         result = client.users_info(user=user_id)
-        return result["user"]["profile"]["email"]
+        email = result["user"]["profile"]["email"]
+        with _cache_lock:
+            _email_cache[user_id] = email
+        return email
     except SlackApiError as e:
-        logging.error(f"Slackメール取得エラー: {e}")
+        logger.error("Slackメール取得エラー: %s", e)
         return None
 
+class FreeeUnavailableError(requests.exceptions.ConnectionError):
+    """サーキットブレーカーが開いており、freee APIを呼び出さなかったことを表す"""
+
+def send_freee_request(method, url, **kwargs):
+    """freee APIにリクエストを送信する（5xxはサーキットブレーカーの失敗として数えるため例外にする）"""
+    response = FREEE_SESSION.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+def freee_request(method, url, **kwargs):
+    """サーキットブレーカー経由でfreee APIを呼び出す"""
+    try:
+        return FREEE_BREAKER.call(send_freee_request, method, url, **kwargs)
+    except pybreaker.CircuitBreakerError as e:
+        raise FreeeUnavailableError("freee APIの障害を検知したため、呼び出しを一時停止しています") from e
+
+def freee_error_text(text):
+    """freeeの障害を検知している間は、その旨をエラーメッセージに付け加える"""
+    if FREEE_BREAKER.current_state == pybreaker.STATE_OPEN:
+        return f"{text}\nfreee側で障害が発生しています。しばらくしてから再度お試しください。"
+    return text
+
 def get_freee_employee_id_by_email(email):
-    """メールアドレスからfreeeの従業員IDを取得"""
-    url = f"https://api.freee.co.jp/hr/api/v1/companies/{FREEEE_COMPANY_ID}/employees"
-    headers = {"Authorization": f"Bearer {FREEEE_API_TOKEN}"}
+    """メールアドレスからfreeeの従業員IDを取得（キャッシュ済みであればAPIを呼ばない）"""
+    with _cache_lock:
+        employee_id = _employee_id_cache.get(email)
+    if employee_id:
+        return employee_id
     params = {"email": email}
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = freee_request("GET", FREEE_EMPLOYEES_URL, params=params)
         response.raise_for_status()
         employees = response.json()
         if employees:
-            return employees[0]["id"]
+            employee_id = employees[0]["id"]
+            with _cache_lock:
+                _employee_id_cache[email] = employee_id
+            return employee_id
         return None
     except requests.exceptions.RequestException as e:
-        logging.error(f"freee従業員検索エラー: {e}")
-        return None
+        logger.error("freee従業員検索エラー: %s", e)
+        # 該当者なし(None)と区別できるよう、通信の失敗は呼び出し元に伝える
+        raise
 
-def call_freee_time_clock(employee_id, clock_type, note=None):
+def call_freee_time_clock(employee_id, clock_type, note=None, user_id=None):
     """freeeに打刻データを送信"""
-    url = f"https://api.freee.co.jp/hr/api/v1/employees/{employee_id}/time_clocks"
-    headers = {"Authorization": f"Bearer {FREEEE_API_TOKEN}", "Content-Type": "application/json"}
+    url = FREEE_TIME_CLOCKS_URL.format(employee_id=employee_id)
     now = datetime.datetime.now()
     data = {
-        "company_id": int(FREEEE_COMPANY_ID),
+        "company_id": FREEEE_COMPANY_ID_INT,
         "type": clock_type,
-        "base_date": now.strftime('%Y-%m-%d'),
-        "datetime": now.strftime('%Y-%m-%d %H:%M:%S')
+        "base_date": now.date().isoformat(),
+        "datetime": now.isoformat(sep=' ', timespec='seconds')
     }
     if note:
         data["note"] = note
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = freee_request("POST", url, data=orjson.dumps(data))
         response.raise_for_status()
         return True
     except requests.exceptions.RequestException as e:
-        logging.error(f"freee打刻APIエラー: {e.response.text}")
+        logger.error("freee打刻APIエラー: %s", e.response.text if e.response is not None else e)
+        invalidate_employee_id_if_not_found(user_id, e)
         return False
 
 def update_freee_attendance_tag(employee_id, date, tag_id):
-    """freeeの勤怠タグを更新する"""
-    url = f"https://api.freee.co.jp/hr/api/v1/employees/{employee_id}/work_records/{date}"
-    headers = {"Authorization": f"Bearer {FREEEE_API_TOKEN}", "Content-Type": "application/json"}
-    data = { "company_id": int(FREEEE_COMPANY_ID), "employee_attendance_tags": [{"attendance_tag_id": int(tag_id), "amount": 1}] }
-    try:
-        response = requests.put(url, headers=headers, json=data)
-        response.raise_for_status()
-        return True
-    except requests.exceptions.RequestException as e:
-        logging.error(f"freee勤怠タグ更新エラー: {e.response.text}")
-        return False
+    """freeeの勤怠タグを更新する（勤務記録がまだ反映されていなければ待って再試行する）"""
+    url = FREEE_WORK_RECORD_URL.format(employee_id=employee_id, date=date)
+    # 再試行しても内容は変わらないため、ボディは一度だけシリアライズする
+    data = orjson.dumps({ "company_id": FREEEE_COMPANY_ID_INT, "employee_attendance_tags": [{"attendance_tag_id": tag_id, "amount": 1}] })
+    for attempt in range(TAG_UPDATE_MAX_ATTEMPTS):
+        try:
+            response = freee_request("PUT", url, data=data)
+            if response.status_code == 404 and attempt < TAG_UPDATE_MAX_ATTEMPTS - 1:
+                time.sleep(0.3 * 2 ** attempt)
+                continue
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.error("freee勤怠タグ更新エラー: %s", e.response.text if e.response is not None else e)
+            return False
 
 def get_freee_leave_types(employee_id):
-    """freeeから従業員が利用可能な休暇種別の一覧を取得する"""
-    url = f"https://api.freee.co.jp/hr/api/v1/employees/{employee_id}/work_records/templates"
-    headers = {"Authorization": f"Bearer {FREEEE_API_TOKEN}"}
+    """freeeから従業員が利用可能な休暇種別の一覧を(id, name)のタプルで取得する"""
+    url = FREEE_WORK_RECORD_TEMPLATES_URL.format(employee_id=employee_id)
     try:
-        response = requests.get(url, headers=headers)
+        response = freee_request("GET", url)
         response.raise_for_status()
         templates = response.json()
-        return [{"id": t["id"], "name": t["name"]} for t in templates if t.get("category") == "leave"]
+        leave_types = [(t["id"], t["name"]) for t in templates if t.get("category") == "leave"]
+        with _cache_lock:
+            _leave_types_cache[employee_id] = leave_types
+        return leave_types
     except requests.exceptions.RequestException as e:
-        logging.error(f"freee休暇種別取得エラー: {e}")
+        logger.error("freee休暇種別取得エラー: %s", e)
         return None
 
-def submit_freee_leave_request(employee_id, leave_type_id, start_date, end_date):
-    """freeeに休暇申請を送信（勤務記録を更新）"""
-    current_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
-    end_date_obj = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
-    
-    while current_date <= end_date_obj:
-        date_str = current_date.strftime('%Y-%m-%d')
-        url = f"https://api.freee.co.jp/hr/api/v1/employees/{employee_id}/work_records/{date_str}"
-        headers = {"Authorization": f"Bearer {FREEEE_API_TOKEN}", "Content-Type": "application/json"}
-        data = {"company_id": int(FREEEE_COMPANY_ID), "work_record_template_id": leave_type_id}
-        try:
-            response = requests.put(url, headers=headers, json=data)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"{date_str}のfreee休暇申請登録エラー: {e.response.text}")
-            return False
-        current_date += datetime.timedelta(days=1)
-    return True
+def get_cached_freee_leave_types(employee_id):
+    """キャッシュ済みの休暇種別一覧を返す（なければNone）"""
+    with _cache_lock:
+        return _leave_types_cache.get(employee_id)
+
+def put_freee_leave_work_record(employee_id, leave_type_id, date_str, user_id=None):
+    """freeeの指定日の勤務記録に休暇テンプレートを適用する"""
+    url = FREEE_WORK_RECORD_URL.format(employee_id=employee_id, date=date_str)
+    data = {"company_id": FREEEE_COMPANY_ID_INT, "work_record_template_id": leave_type_id}
+    try:
+        response = freee_request("PUT", url, data=orjson.dumps(data))
+        response.raise_for_status()
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.error("%sのfreee休暇申請登録エラー: %s", date_str, e.response.text if e.response is not None else e)
+        invalidate_employee_id_if_not_found(user_id, e)
+        return False
+
+def submit_freee_leave_request(employee_id, leave_type_id, start_date, end_date, user_id=None):
+    """freeeに休暇申請を送信（期間内の勤務記録を並列で更新し、登録に失敗した日付の一覧を返す）"""
+    start_date_obj = datetime.date.fromisoformat(start_date)
+    end_date_obj = datetime.date.fromisoformat(end_date)
+    dates = [(start_date_obj + datetime.timedelta(days=i)).isoformat() for i in range((end_date_obj - start_date_obj).days + 1)]
+
+    with ThreadPoolExecutor(max_workers=LEAVE_REQUEST_MAX_CONCURRENCY) as executor:
+        futures = [executor.submit(put_freee_leave_work_record, employee_id, leave_type_id, date_str, user_id) for date_str in dates]
+        return [date_str for date_str, future in zip(dates, futures) if not future.result()]
 
 def add_event_to_google_calendar(summary, start_date, end_date):
     """Googleカレンダーに終日予定を追加"""
     try:
         creds = get_google_credentials()
-        service = build('calendar', 'v3', credentials=creds)
-        end_date_for_api = (datetime.datetime.strptime(end_date, '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        end_date_for_api = (datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1)).isoformat()
         event = {'summary': summary, 'start': {'date': start_date}, 'end': {'date': end_date_for_api}}
-        service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event).execute()
+        url = f"https://www.googleapis.com/calendar/v3/calendars/{quote(GOOGLE_CALENDAR_ID, safe='')}/events"
+        response = GOOGLE_SESSION.post(url, headers={"Authorization": f"Bearer {creds.token}"}, json=event, timeout=HTTP_TIMEOUT)
+        if response.status_code == 401:
+            # キャッシュ済みのトークンが失効・取り消されていた場合は、取り直して一度だけ再送する
+            invalidate_google_credentials()
+            creds = get_google_credentials()
+            response = GOOGLE_SESSION.post(url, headers={"Authorization": f"Bearer {creds.token}"}, json=event, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
         return True
     except Exception as e:
-        logging.error(f"Googleカレンダー追加エラー: {e}")
+        logger.error("Googleカレンダー追加エラー: %s", e)
         return False
 
 # ----------------------------------------------------
 # 共通ヘルパー
 # ----------------------------------------------------
+def get_cached_employee_id(user_id):
+    """キャッシュ（メモリ→SQLite）だけを見て従業員IDを返す（外部APIは呼ばない）"""
+    with _cache_lock:
+        entry = _user_to_employee_id_cache.get(user_id)
+    if entry:
+        return entry[0]
+    entry = load_persisted_employee_id(user_id)
+    if not entry:
+        return None
+    # SQLiteに保存された時刻を引き継ぎ、メモリ上で有効期限が延びないようにする
+    with _cache_lock:
+        _user_to_employee_id_cache[user_id] = entry
+    return entry[0]
+
 def get_employee_id_wrapper(user_id, client):
+    employee_id = get_cached_employee_id(user_id)
+    if employee_id:
+        return employee_id
     email = get_email_from_slack(user_id, client)
     if not email:
         client.chat_postMessage(channel=user_id, text="エラー: Slackからメールアドレスを取得できませんでした。")
         return None
-    employee_id = get_freee_employee_id_by_email(email)
+    try:
+        employee_id = get_freee_employee_id_by_email(email)
+    except requests.exceptions.RequestException:
+        # 通信エラーやfreeeの障害を「従業員情報がない」と誤って案内しないよう、別のメッセージにする
+        client.chat_postMessage(channel=user_id, text=freee_error_text("エラー: freeeから従業員情報を取得できませんでした。"))
+        return None
     if not employee_id:
         client.chat_postMessage(channel=user_id, text=f"エラー: freeeにあなたの従業員情報が見つかりませんでした。(Email: {email})")
         return None
+    updated_at = int(time.time())
+    with _cache_lock:
+        _user_to_employee_id_cache[user_id] = (employee_id, updated_at)
+    save_persisted_employee_id(user_id, employee_id, updated_at)
     return employee_id
 
+def invalidate_employee_id(user_id):
+    """キャッシュ済みのSlackユーザー→freee従業員IDの対応を破棄し、次回は取り直させる"""
+    with _cache_lock:
+        _user_to_employee_id_cache.pop(user_id, None)
+        email = _email_cache.get(user_id)
+        if email:
+            _employee_id_cache.pop(email, None)
+    delete_persisted_employee_id(user_id)
+
+def invalidate_employee_id_if_not_found(user_id, e):
+    """キャッシュから取った従業員IDをfreeeが404で拒否した場合、その対応を破棄する"""
+    if user_id and e.response is not None and e.response.status_code == 404:
+        logger.warning("freeeに従業員IDが見つからないため、%sのキャッシュを破棄します", user_id)
+        invalidate_employee_id(user_id)
+
+def log_background_error(future):
+    """バックグラウンド処理で発生した例外をログに残す"""
+    if future.exception():
+        logger.error("バックグラウンド処理エラー", exc_info=future.exception())
+
+def run_in_background(func, *args):
+    """ack()後の処理をバックグラウンドスレッドで実行する"""
+    BACKGROUND_EXECUTOR.submit(func, *args).add_done_callback(log_background_error)
+
+def apply_clock_in_tag(client, user_id, employee_id, date, tag_id, tag_name):
+    """出勤打刻後に勤怠タグを設定し、結果をSlackに通知する"""
+    if update_freee_attendance_tag(employee_id, date, tag_id):
+        client.chat_postMessage(channel=user_id, text=f"勤怠タグ「{tag_name}」の設定が完了しました！")
+    else:
+        client.chat_postMessage(channel=user_id, text="出勤打刻は完了しましたが、勤怠タグの更新に失敗しました。")
+
+# ----------------------------------------------------
+# Slackモーダル定義（内容が固定の部分は起動時に一度だけ組み立てる）
+# ----------------------------------------------------
+
+CLOCK_IN_VIEW = {"type": "modal", "callback_id": "clock_in_modal", "title": {"type": "plain_text", "text": "出勤打刻"},
+                 "submit": {"type": "plain_text", "text": "打刻"}, "blocks": [
+                   {"type": "input", "block_id": "location_block", "label": {"type": "plain_text", "text": "勤怠タグ"},
+                    "element": {"type": "static_select", "action_id": "location_select", "placeholder": {"type": "plain_text", "text": "勤務形態を選択"},
+                                "options": [
+                                    {"text": {"type": "plain_text", "text": "🏠 在宅勤務"}, "value": "13548:在宅勤務"},
+                                    {"text": {"type": "plain_text", "text": "🏢 本社勤務"}, "value": "3733:本社勤務"},
+                                    {"text": {"type": "plain_text", "text": "💼 現場出社"}, "value": "3732:現場出社"},
+                                    {"text": {"type": "plain_text", "text": "✈️ 出張"}, "value": "3734:出張"}
+                                ]}}]}
+
+APPLICATION_TYPE_VIEW = {
+    "type": "modal",
+    "callback_id": "select_application_type_view",
+    "title": {"type": "plain_text", "text": "各種申請"},
+    "submit": {"type": "plain_text", "text": "次へ"},
+    "blocks": [
+        {"type": "input", "block_id": "application_type_block", "label": {"type": "plain_text", "text": "申請種別"},
+         "element": {"type": "static_select", "action_id": "application_type_select", "placeholder": {"type": "plain_text", "text": "申請の種類を選択"},
+                     "options": [
+                         {"text": {"type": "plain_text", "text": "有給休暇・特別休暇・欠勤"}, "value": "leave_request"},
+                         {"text": {"type": "plain_text", "text": "勤怠時間修正"}, "value": "time_correction"},
+                         {"text": {"type": "plain_text", "text": "休日出勤申請"}, "value": "holiday_work"},
+                         {"text": {"type": "plain_text", "text": "振替休日申請"}, "value": "compensatory_leave"},
+                         {"text": {"type": "plain_text", "text": "勤怠タグ修正"}, "value": "tag_correction"},
+                     ]}}]}
+
+LEAVE_TYPES_LOADING_VIEW = {"type": "modal", "title": {"type": "plain_text", "text": "申請内容の入力"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "freeeから休暇種別を取得しています..."}}]}
+EMPLOYEE_ERROR_VIEW = {"type": "modal", "title": {"type": "plain_text", "text": "エラー"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "従業員情報を取得できませんでした。詳細はDMをご確認ください。"}}]}
+LEAVE_TYPES_ERROR_VIEW = {"type": "modal", "title": {"type": "plain_text", "text": "エラー"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "freeeから休暇種別を取得できませんでした。"}}]}
+NOT_IMPLEMENTED_VIEW = {"type": "modal", "title": {"type": "plain_text", "text": "エラー"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "この申請はまだ実装されていません。"}}]}
+
+# 休暇申請フォームの理由欄（休暇種別の選択肢と日付の初期値以外は固定）
+LEAVE_REQUEST_REASON_BLOCK = {"type": "input", "block_id": "reason_block", "label": {"type": "plain_text", "text": "詳細理由（任意）"}, "optional": True, "element": {"type": "plain_text_input", "action_id": "reason_input", "placeholder": {"type": "plain_text", "text": "例：通院のため"}, "multiline": True}}
+
 # ----------------------------------------------------
 # Slackコマンドハンドラー
 # ----------------------------------------------------
@@ -187,61 +480,28 @@ def get_employee_id_wrapper(user_id, client):
 @app.command("/出勤")
 def handle_clock_in_command(ack, body, client):
     ack()
-    client.views_open(
-        trigger_id=body["trigger_id"],
-        view={"type": "modal", "callback_id": "clock_in_modal", "title": {"type": "plain_text", "text": "出勤打刻"},
-              "submit": {"type": "plain_text", "text": "打刻"}, "blocks": [
-                {"type": "input", "block_id": "location_block", "label": {"type": "plain_text", "text": "勤怠タグ"},
-                 "element": {"type": "static_select", "action_id": "location_select", "placeholder": {"type": "plain_text", "text": "勤務形態を選択"},
-                             "options": [
-                                 {"text": {"type": "plain_text", "text": "🏠 在宅勤務"}, "value": "13548:在宅勤務"},
-                                 {"text": {"type": "plain_text", "text": "🏢 本社勤務"}, "value": "3733:本社勤務"},
-                                 {"text": {"type": "plain_text", "text": "💼 現場出社"}, "value": "3732:現場出社"},
-                                 {"text": {"type": "plain_text", "text": "✈️ 出張"}, "value": "3734:出張"}
-                             ]}}]}
-    )
+    client.views_open(trigger_id=body["trigger_id"], view=CLOCK_IN_VIEW)
 
 @app.command("/退勤")
 def handle_clock_out_command(ack, body, client):
     ack()
+    run_in_background(process_clock_out, body, client)
+
+def process_clock_out(body, client):
+    """退勤打刻をfreeeに送信する"""
     employee_id = get_employee_id_wrapper(body["user_id"], client)
-    if employee_id and call_freee_time_clock(employee_id, "clock_out"):
+    if employee_id and call_freee_time_clock(employee_id, "clock_out", user_id=body["user_id"]):
         client.chat_postMessage(channel=body["user_id"], text="退勤打刻が完了しました。お疲れ様でした！")
     else:
-        client.chat_postMessage(channel=body["user_id"], text="エラー: freeeへの打刻処理に失敗しました。")
+        client.chat_postMessage(channel=body["user_id"], text=freee_error_text("エラー: freeeへの打刻処理に失敗しました。"))
 
 @app.command("/各種申請")
 def handle_applications_command(ack, body, client):
     """/各種申請 コマンドで、申請種別を選択するモーダルを開く"""
     ack()
-    
-    # 後続の処理で従業員IDが必要になるため、この時点で取得しておく
-    employee_id = get_employee_id_wrapper(body["user_id"], client)
-    if not employee_id:
-        return # エラーメッセージはwrapper内で送信される
-
-    # employee_idを後続のモーダルに渡すためにprivate_metadataに埋め込む
-    view_private_metadata = {"employee_id": employee_id}
-
-    client.views_open(
-        trigger_id=body["trigger_id"],
-        view={
-            "type": "modal",
-            "private_metadata": json.dumps(view_private_metadata),
-            "callback_id": "select_application_type_view",
-            "title": {"type": "plain_text", "text": "各種申請"},
-            "submit": {"type": "plain_text", "text": "次へ"},
-            "blocks": [
-                {"type": "input", "block_id": "application_type_block", "label": {"type": "plain_text", "text": "申請種別"},
-                 "element": {"type": "static_select", "action_id": "application_type_select", "placeholder": {"type": "plain_text", "text": "申請の種類を選択"},
-                             "options": [
-                                 {"text": {"type": "plain_text", "text": "有給休暇・特別休暇・欠勤"}, "value": "leave_request"},
-                                 {"text": {"type": "plain_text", "text": "勤怠時間修正"}, "value": "time_correction"},
-                                 {"text": {"type": "plain_text", "text": "休日出勤申請"}, "value": "holiday_work"},
-                                 {"text": {"type": "plain_text", "text": "振替休日申請"}, "value": "compensatory_leave"},
-                                 {"text": {"type": "plain_text", "text": "勤怠タグ修正"}, "value": "tag_correction"},
-                             ]}}]}
-    )
+    # trigger_idの有効期限(3秒)内に確実に開けるよう、API呼び出しを挟まずに固定のモーダルをすぐ開く
+    # 従業員IDは申請種別の選択後に解決する
+    client.views_open(trigger_id=body["trigger_id"], view=APPLICATION_TYPE_VIEW)
 
 # ----------------------------------------------------
 # Slackモーダルハンドラー
@@ -250,6 +510,10 @@ def handle_applications_command(ack, body, client):
 @app.view("clock_in_modal")
 def handle_clock_in_submission(ack, body, client, view):
     ack()
+    run_in_background(process_clock_in_submission, body, client, view)
+
+def process_clock_in_submission(body, client, view):
+    """出勤打刻をfreeeに送信し、勤怠タグの設定を開始する"""
     user_id = body["user"]["id"]
     selected_option = view["state"]["values"]["location_block"]["location_select"]["selected_option"]["value"]
     tag_id, tag_name = selected_option.split(':', 1)
@@ -258,87 +522,103 @@ def handle_clock_in_submission(ack, body, client, view):
     if not employee_id:
         return
 
-    if not call_freee_time_clock(employee_id, "clock_in"):
-        client.chat_postMessage(channel=user_id, text="エラー: freeeへの打刻処理に失敗しました。")
+    if not call_freee_time_clock(employee_id, "clock_in", user_id=user_id):
+        client.chat_postMessage(channel=user_id, text=freee_error_text("エラー: freeeへの打刻処理に失敗しました。"))
         return
-        
-    # logging.info("freee側の処理を3秒待機します...")
-    #time.sleep(3)
-        
+
+    # 勤怠タグの設定はfreee側の反映待ちがあるため、バックグラウンドで行い完了時に改めて通知する
+    client.chat_postMessage(channel=user_id, text=f"出勤打刻が完了しました。勤怠タグ「{tag_name}」を設定しています...")
     today_str = datetime.date.today().isoformat()
-    if update_freee_attendance_tag(employee_id, today_str, int(tag_id)):
-        client.chat_postMessage(channel=user_id, text=f"出勤打刻と勤怠タグ「{tag_name}」の設定が完了しました！")
-    else:
-        client.chat_postMessage(channel=user_id, text="出勤打刻は完了しましたが、勤怠タグの更新に失敗しました。")
+    run_in_background(apply_clock_in_tag, client, user_id, employee_id, today_str, int(tag_id), tag_name)
 
 @app.view("select_application_type_view")
 def handle_select_application_type(ack, body, client, view):
     """申請種別を選択後、専用のモーダルに切り替える"""
     ack()
     selected_type = view["state"]["values"]["application_type_block"]["application_type_select"]["selected_option"]["value"]
-    
-    # private_metadataからemployee_idを取得
-    private_metadata = json.loads(view["private_metadata"])
-    employee_id = private_metadata["employee_id"]
-    
-    today = datetime.date.today().isoformat()
-    new_view_blocks = []
-    callback_id = ""
-
-    if selected_type == "leave_request":
-        callback_id = "submit_leave_request_view"
-        
-        # employee_idを渡して関数を呼び出す
-        leave_types = get_freee_leave_types(employee_id)
-        if leave_types is None:
-            # エラーモーダルを表示
-            client.views_update(
-                view_id=body["view"]["id"],
-                hash=body["view"]["hash"],
-                view={"type": "modal", "title": {"type": "plain_text", "text": "エラー"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "freeeから休暇種別を取得できませんでした。"}}]}
-            )
-            return
-        
-        options = [{"text": {"type": "plain_text", "text": leave["name"]}, "value": f"{leave['id']}:{leave['name']}"} for leave in leave_types]
-        
-        new_view_blocks = [
-            {"type": "input", "block_id": "leave_type_block", "label": {"type": "plain_text", "text": "休暇種別"}, "element": {"type": "static_select", "action_id": "leave_type_select", "placeholder": {"type": "plain_text", "text": "休暇種別を選択"}, "options": options}},
-            {"type": "input", "block_id": "start_date_block", "label": {"type": "plain_text", "text": "開始日"}, "element": {"type": "datepicker", "action_id": "start_date_picker", "initial_date": today}},
-            {"type": "input", "block_id": "end_date_block", "label": {"type": "plain_text", "text": "終了日"}, "element": {"type": "datepicker", "action_id": "end_date_picker", "initial_date": today}},
-            {"type": "input", "block_id": "reason_block", "label": {"type": "plain_text", "text": "詳細理由（任意）"}, "optional": True, "element": {"type": "plain_text_input", "action_id": "reason_input", "placeholder": {"type": "plain_text", "text": "例：通院のため"}, "multiline": True}}
-        ]
-    
-    else:
+
+    if selected_type != "leave_request":
         # 未実装の場合の処理
         client.views_update(
             view_id=body["view"]["id"],
             hash=body["view"]["hash"],
-            view={"type": "modal", "title": {"type": "plain_text", "text": "エラー"}, "blocks": [{"type": "section", "text": {"type": "plain_text", "text": "この申請はまだ実装されていません。"}}]}
+            view=NOT_IMPLEMENTED_VIEW
         )
         return
 
-    # モーダルを新しい内容で更新（積み重ねる）
-    client.views_push(
+    # trigger_idの有効期限(3秒)内に確実に使えるよう、views_pushはバックグラウンドに回さずここで行う
+    user_id = body["user"]["id"]
+    # 休暇申請の送信時に必要になるため、ここで従業員IDを取得しておく（キャッシュにあればAPIは呼ばない）
+    employee_id = get_cached_employee_id(user_id)
+    leave_types = get_cached_freee_leave_types(employee_id) if employee_id else None
+    if leave_types is not None:
+        client.views_push(trigger_id=body["trigger_id"], view=build_leave_request_view(employee_id, leave_types))
+        return
+
+    # SlackやfreeeへのAPI呼び出しを待たずに読み込み中のモーダルを表示し、取得後に入力フォームへ差し替える
+    loading_view = client.views_push(
         trigger_id=body["trigger_id"],
-        view={
-            "type": "modal",
-            "private_metadata": json.dumps(private_metadata), # employee_idをさらに次のモーダルへ渡す
-            "callback_id": callback_id,
-            "title": {"type": "plain_text", "text": "申請内容の入力"},
-            "submit": {"type": "plain_text", "text": "申請"},
-            "blocks": new_view_blocks
-        }
-    )
+        view=LEAVE_TYPES_LOADING_VIEW
+    )["view"]
+    run_in_background(load_leave_request_view, client, user_id, employee_id, loading_view)
+
+def load_leave_request_view(client, user_id, employee_id, loading_view):
+    """従業員IDと休暇種別を取得し、読み込み中のモーダルを入力フォーム（失敗時はエラー）に差し替える"""
+    if not employee_id:
+        employee_id = get_employee_id_wrapper(user_id, client)
+        if not employee_id:
+            # エラーメッセージはwrapper内で送信されるため、モーダルにはその旨だけ表示する
+            client.views_update(
+                view_id=loading_view["id"],
+                hash=loading_view["hash"],
+                view=EMPLOYEE_ERROR_VIEW
+            )
+            return
+
+    leave_types = get_freee_leave_types(employee_id)
+    if leave_types is None:
+        # エラーモーダルを表示
+        client.views_update(
+            view_id=loading_view["id"],
+            hash=loading_view["hash"],
+            view=LEAVE_TYPES_ERROR_VIEW
+        )
+        return
+
+    # 読み込み中のモーダルを入力フォームに差し替える
+    client.views_update(view_id=loading_view["id"], hash=loading_view["hash"], view=build_leave_request_view(employee_id, leave_types))
+
+def build_leave_request_view(employee_id, leave_types):
+    """休暇申請の入力フォームを組み立てる"""
+    today = datetime.date.today().isoformat()
+    options = [{"text": {"type": "plain_text", "text": name}, "value": f"{leave_id}:{name}"} for leave_id, name in leave_types]
+    return {
+        "type": "modal",
+        # employee_idを後続のモーダルに渡すためにprivate_metadataに埋め込む
+        "private_metadata": orjson.dumps({"employee_id": employee_id}).decode(),
+        "callback_id": "submit_leave_request_view",
+        "title": {"type": "plain_text", "text": "申請内容の入力"},
+        "submit": {"type": "plain_text", "text": "申請"},
+        "blocks": [
+            {"type": "input", "block_id": "leave_type_block", "label": {"type": "plain_text", "text": "休暇種別"}, "element": {"type": "static_select", "action_id": "leave_type_select", "placeholder": {"type": "plain_text", "text": "休暇種別を選択"}, "options": options}},
+            {"type": "input", "block_id": "start_date_block", "label": {"type": "plain_text", "text": "開始日"}, "element": {"type": "datepicker", "action_id": "start_date_picker", "initial_date": today}},
+            {"type": "input", "block_id": "end_date_block", "label": {"type": "plain_text", "text": "終了日"}, "element": {"type": "datepicker", "action_id": "end_date_picker", "initial_date": today}},
+            LEAVE_REQUEST_REASON_BLOCK
+        ]
+    }
 
 @app.view("submit_leave_request_view")
 def handle_submit_leave_request(ack, body, client, view):
-    """休暇申請をfreeeに送信する"""
     ack()
+    run_in_background(process_submit_leave_request, body, client, view)
+
+def process_submit_leave_request(body, client, view):
+    """休暇申請をfreeeに送信する"""
     user_id = body["user"]["id"]
     values = body["view"]["state"]["values"]
     
     # private_metadataからemployee_idを取得
-    private_metadata = json.loads(view["private_metadata"])
+    private_metadata = orjson.loads(view["private_metadata"])
     employee_id = private_metadata["employee_id"]
     
     selected_option = values["leave_type_block"]["leave_type_select"]["selected_option"]["value"]
@@ -346,14 +626,28 @@ def handle_submit_leave_request(ack, body, client, view):
     start_date = values["start_date_block"]["start_date_picker"]["selected_date"]
     end_date = values["end_date_block"]["end_date_picker"]["selected_date"]
 
-    if submit_freee_leave_request(employee_id, int(leave_type_id), start_date, end_date):
+    failed_dates = submit_freee_leave_request(employee_id, int(leave_type_id), start_date, end_date, user_id=user_id)
+    if not failed_dates:
         client.chat_postMessage(channel=user_id, text=f"休暇申請をfreeeに提出しました。\n種別：{leave_type_name}\n期間：{start_date} ~ {end_date}\nfreee上で承認されるのをお待ちください。")
     else:
-        client.chat_postMessage(channel=user_id, text="エラー: freeeへの休暇申請に失敗しました。")
+        client.chat_postMessage(channel=user_id, text=freee_error_text(f"エラー: freeeへの休暇申請に失敗しました。\n失敗した日付：{', '.join(failed_dates)}"))
 
 # ----------------------------------------------------
 # アプリケーション起動
 # ----------------------------------------------------
+
+class ThreadedSlackRequestHandler(SlackRequestHandler):
+    """同期のApp.dispatchをスレッドで実行し、イベントループを塞がずに複数のリクエストを並行して受け付ける"""
+    async def dispatch(self, request):
+        bolt_request = BoltRequest(body=await request.get_raw_body(), query=request.query_string, headers=request.get_headers())
+        return await asyncio.to_thread(self.app.dispatch, bolt_request)
+
+# 本番環境（Cloud Run）ではHTTPモードのASGIアプリとしてuvicornから起動する（/slack/events で受け付ける）
+api = ThreadedSlackRequestHandler(app)
+
 if __name__ == "__main__":
-    logging.info("🤖 WorkStamper is running!")
-    SocketModeHandler(app, SLACK_APP_TOKEN).start()
\ No newline at end of file
+    # ローカル開発時のみSocket Modeで起動する
+    from slack_bolt.adapter.socket_mode import SocketModeHandler
+
+    logger.info("🤖 WorkStamper is running!")
+    SocketModeHandler(app, SLACK_APP_TOKEN, concurrency=SLACK_SOCKET_MODE_CONCURRENCY).start()
\ No newline at end of file